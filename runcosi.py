@@ -9,95 +9,178 @@ __author__="ilya_shl@alum.mit.edu"
 # * imports
 
 import argparse
-import collections
 import concurrent.futures
 import contextlib
 import functools
-import gzip
 import io
 import json
 import logging
+import mmap
 import multiprocessing
 import os
-import random
 import re
+import secrets
+import shutil
+import stat
 import subprocess
 import sys
 import time
 
+try:
+    from isal import igzip as _gzip  # ISA-L accelerated drop-in replacement for the gzip module
+except ImportError:
+    import gzip as _gzip
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # * Utils
 
 _log = logging.getLogger(__name__)
 
 MAX_INT32 = (2 ** 31)-1
 
+def _run(argv, **kwargs):
+    """Run a command given as an argv list (no shell), raising subprocess.CalledProcessError if it fails"""
+    return subprocess.run(argv, check=True, **kwargs)
+
 def dump_file(fname, value):
     """store string in file"""
     with open(fname, 'w')  as out:
         out.write(str(value))
 
-def _pretty_print_json(json_val, sort_keys=True):
-    """Return a pretty-printed version of a dict converted to json, as a string."""
-    return json.dumps(json_val, indent=4, separators=(',', ': '), sort_keys=sort_keys)
-
-def _write_json(fname, json_val):
-    dump_file(fname=fname, value=_pretty_print_json(json_val))
-
-def _load_dict_sorted(d):
-    return collections.OrderedDict(sorted(d.items()))
+# indentation of pretty-printed json; orjson only supports 2
+JSON_INDENT = 2 if orjson is not None else 4
+
+def _dump_json(json_val, out, base_indent=0):
+    """Write a pretty-printed version of `json_val` converted to json, with sorted keys, to binary file `out`,
+    with no intermediate str.  Lines after the first are indented by an extra `base_indent` spaces, for nesting
+    the output inside an enclosing json value.
+
+    Note that the output format depends on the environment: if orjson is installed it is used, and it indents
+    by 2 spaces; otherwise the json module is used, indenting by 4 (see JSON_INDENT).  The json value written
+    is the same either way."""
+    # json strings never contain raw newlines, so each newline in the output starts a new line of layout
+    newline = '\n' + ' '*base_indent
+    if orjson is not None:
+        out.write(orjson.dumps(json_val, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS).replace(b'\n', newline.encode()))
+    else:
+        encoder = json.JSONEncoder(indent=JSON_INDENT, separators=(',', ': '), sort_keys=True)
+        for chunk in encoder.iterencode(json_val):
+            out.write(chunk.replace('\n', newline).encode())
 
 def _json_loads(s):
-    return json.loads(s.strip(), object_hook=_load_dict_sorted, object_pairs_hook=collections.OrderedDict)
+    if orjson is not None:
+        return orjson.loads(s)
+    return json.loads(s)
+
+def _orjson_load_mmap(fname):
+    """Parse uncompressed json file `fname` with orjson, directly from a read-only memory map of it,
+    without reading it into memory.  Requires orjson: json.loads() does not accept an mmap buffer."""
+    if orjson is None:
+        raise RuntimeError('_orjson_load_mmap requires the orjson module')
+    with open(fname, 'rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # an empty file cannot be mmapped; have orjson report it as invalid json
+            return orjson.loads(b'')
+        with mm, memoryview(mm) as buf:
+            return orjson.loads(buf)
 
 def _json_loadf(fname):
-    return _json_loads(slurp_file(fname))
+    if orjson is not None and not fname.endswith('.gz'):
+        return _orjson_load_mmap(fname)
+    if orjson is not None:
+        # orjson has no streaming parser, but parsing the whole (decompressed) text at once is still faster
+        with open_or_gzopen(fname, 'rb') as f:
+            return orjson.loads(f.read())
+    with open_or_gzopen(fname, 'rt') as f:
+        return json.load(f)
 
 
 def slurp_file(fname, maxSizeMb=50):
     """Read entire file into one string.  If file is gzipped, uncompress it on-the-fly.  If file is larger
     than `maxSizeMb` megabytes, throw an error; this is to encourage proper use of iterators for reading
-    large files.  If `maxSizeMb` is None or 0, file size is unlimited."""
-    fileSize = os.path.getsize(fname)
-    if maxSizeMb  and  fileSize > maxSizeMb*1024*1024:
-        raise RuntimeError('Tried to slurp large file {} (size={}); are you sure?  Increase `maxSizeMb` param if yes'.
-                           format(fname, fileSize))
+    large files.  If `maxSizeMb` is None or 0, file size is unlimited.  The size limit is not checked for
+    gzipped files, since only their compressed size is known in advance."""
     with open_or_gzopen(fname) as f:
+        if maxSizeMb  and  not fname.endswith('.gz'):
+            fileSize = os.fstat(f.fileno()).st_size
+            if fileSize > maxSizeMb*1024*1024:
+                raise RuntimeError('Tried to slurp large file {} (size={}); are you sure?  Increase `maxSizeMb` param if yes'.
+                                   format(fname, fileSize))
         return f.read()
 
+@functools.lru_cache(maxsize=None)
+def _have_pigz():
+    """Whether pigz (parallel gzip) is on PATH; looked up only once."""
+    return shutil.which('pigz') is not None
+
+class _PipedRawReader(io.RawIOBase):
+    """Raw reader of the stdout of a subprocess.  On close, if all output was read, waits for the subprocess and
+    checks its exit status; if the reader is closed early, terminates the subprocess and ignores its exit status."""
+
+    def __init__(self, argv, stdin):
+        super().__init__()
+        self._argv = argv
+        self._proc = subprocess.Popen(argv, stdin=stdin, stdout=subprocess.PIPE, bufsize=0)
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self._proc.stdout.readinto(b)
+        if not n:
+            self._eof = True
+        return n
+
+    def close(self):
+        if self.closed:
+            return
+        proc = getattr(self, '_proc', None)  # None if Popen() failed in __init__
+        returncode = 0
+        try:
+            if proc is not None:
+                proc.stdout.close()
+                if not self._eof:
+                    proc.terminate()
+                returncode = proc.wait()
+        finally:
+            super().close()
+        if self._eof and returncode:
+            raise subprocess.CalledProcessError(returncode, self._argv)
+
+    def __del__(self):
+        # a reader garbage-collected without close() has no caller to report a failure to
+        self._eof = False
+        super().__del__()
+
 def open_or_gzopen(fname, *opts, **kwargs):
-    mode = 'r'
-    open_opts = list(opts)
-    assert type(mode) == str, "open mode must be of type str"
-
-    # 'U' mode is deprecated in py3 and may be unsupported in future versions,
-    # so use newline=None when 'U' is specified
-    if len(open_opts) > 0:
-        mode = open_opts[0]
-        if sys.version_info[0] == 3:
-            if 'U' in mode:
-                if 'newline' not in kwargs:
-                    kwargs['newline'] = None
-                open_opts[0] = mode.replace("U","")
+    mode = opts[0] if opts else 'r'
+
+    # 'U' mode is not supported by open() in py3; universal newlines are requested with newline=None
+    if 'U' in mode:
+        kwargs.setdefault('newline', None)
 
     # if this is a gzip file
     if fname.endswith('.gz'):
-        # if text read mode is desired (by spec or default)
-        if ('b' not in mode) and (len(open_opts)==0 or 'r' in mode):
-            # if python 2
-            if sys.version_info[0] == 2:
-                # gzip.open() under py2 does not support universal newlines
-                # so we need to wrap it with something that does
-                # By ignoring errors in BufferedReader, errors should be handled by TextIoWrapper
-                return io.TextIOWrapper(io.BufferedReader(gzip.open(fname)))
-
-        # if 't' for text mode is not explicitly included,
-        # replace "U" with "t" since under gzip "rb" is the
-        # default and "U" depends on "rt"
-        gz_mode = str(mode).replace("U","" if "t" in mode else "t")
-        gz_opts = [gz_mode]+list(opts)[1:]
-        return gzip.open(fname, *gz_opts, **kwargs)
+        # under gzip "rb" is the default, and "U" implies "t"
+        gz_mode = mode.replace("U", "" if "t" in mode else "t")
+        # kwargs that io.TextIOWrapper accepts; other kwargs, or any kwargs in binary mode, are left to gzip.open()
+        pipe_kwargs = {'encoding', 'errors', 'newline'} if 't' in gz_mode else set()
+        if len(opts) <= 1 and not any(c in gz_mode for c in 'wax+') and set(kwargs) <= pipe_kwargs and _have_pigz():
+            # decompress in a separate process, which is faster than gzip.open() for large inputs
+            with open(fname, 'rb') as compressed:
+                raw = _PipedRawReader(['pigz', '-dc'], stdin=compressed)
+            reader = io.BufferedReader(raw, buffer_size=1024*1024)
+            return io.TextIOWrapper(reader, **kwargs) if 't' in gz_mode else reader
+        return _gzip.open(fname, gz_mode, *opts[1:], **kwargs)
     else:
-        return open(fname, *open_opts, **kwargs)
+        return open(fname, mode.replace("U", ""), *opts[1:], **kwargs)
 
 def available_cpu_count():
     """
@@ -139,50 +222,123 @@ def available_cpu_count():
 
 # * run_one_sim
 
-def run_one_replica(replicaNum, args, paramFile):
-    """Run one cosi2 replica; return a ReplicaInfo struct (defined in Dockstore.wdl).
+def _make_tarball(tpedPrefix, tpeds_tar_gz, timeout=None):
+    """Pack the tped files written by cosi2 under `tpedPrefix` into the gzipped tarball `tpeds_tar_gz`.
+    Compression uses pigz (parallel gzip) if it is installed, else gzip; both at level 1.
+    `timeout`, if given, limits in seconds how long to wait for the tar and compressor processes."""
+    with os.scandir('.') as entries:
+        tpeds = sorted(entry.name for entry in entries
+                       if entry.name.startswith(f'{tpedPrefix}_') and entry.name.endswith('.tped'))
+    if not tpeds:
+        raise RuntimeError(f'no tped files found for prefix {tpedPrefix}')
+    try:
+        compress_argv = ['pigz', '-1', '-p', str(available_cpu_count())] if _have_pigz() else ['gzip', '-1']
+        _tar_through_compressor(tpeds, tpeds_tar_gz, compress_argv, timeout)
+    except BaseException:
+        # do not leave a partial tarball behind
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tpeds_tar_gz)
+        raise
+
+def _tar_through_compressor(tpeds, tpeds_tar_gz, compress_argv, timeout):
+    """Pipe `tar cf -` of the files `tpeds` through the command `compress_argv` into `tpeds_tar_gz`; on any error,
+    kill and reap whichever of the two processes were started."""
+    tar_argv = ['tar', 'cf', '-', '--'] + tpeds
+    procs = []
+    try:
+        with open(tpeds_tar_gz, 'wb') as out:
+            tar_proc = subprocess.Popen(tar_argv, stdout=subprocess.PIPE)
+            procs.append(tar_proc)
+            try:
+                compress_proc = subprocess.Popen(compress_argv, stdin=tar_proc.stdout, stdout=out)
+            finally:
+                tar_proc.stdout.close()  # so that tar gets SIGPIPE if pigz exits early
+            procs.append(compress_proc)
+            compress_proc.wait(timeout=timeout)
+            tar_proc.wait(timeout=timeout)
+    except BaseException:
+        for proc in procs:
+            proc.kill()
+            proc.wait()
+        raise
+    for proc, argv in ((tar_proc, tar_argv), (compress_proc, compress_argv)):
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, argv)
+
+# errors that mark a replica as failed, rather than aborting the block
+REPLICA_ERRORS = (subprocess.SubprocessError, OSError, RuntimeError)
+
+def _failed_replica_fields(emptyFile):
+    """ReplicaInfo fields for a replica that failed; `emptyFile` stands in for its output files."""
+    return dict(succeeded=False, tpeds=emptyFile, traj=emptyFile,
+                selPop=0, selGen=0., selBegPop=0, selBegGen=0., selCoeff=0., selFreq=0.)
+
+def run_one_replica(replicaNum, args, paramFile, emptyFile, tarExecutor):
+    """Run one cosi2 replica; return a ReplicaInfo struct (defined in Dockstore.wdl), and a future for the
+    replica's tpeds tarball (None if the simulation failed).  The tarball is made in `tarExecutor`, so that
+    when there are more replicas than workers, its compression overlaps with the simulation of the next replica;
+    see _finish_replica().
+    `emptyFile` is an existing empty file, used in place of output files for failed replicas.
 
     Note: replicaNum must be first arg, to facilitate concurrent.futures.Executor.map() over range of replicaNums.
     """
 
     time_beg = time.time()
 
-    randomSeed = random.SystemRandom().randint(0, MAX_INT32)
+    randomSeed = secrets.randbits(31)  # uniform over [0, MAX_INT32]
 
     repStr = f"rep{replicaNum}"
     blkStr = f"{args.simBlockId}.{repStr}"
     tpedPrefix = f"{blkStr}"
     trajFile = f"{blkStr}.traj"
     sweepInfoFile = f"{blkStr}.sweepinfo.tsv"
-    _run = functools.partial(subprocess.check_call, shell=True)
-    emptyFile = f"{blkStr}.empty"
-    dump_file(emptyFile, '')
-    cosi2_cmd = (
-        f'(env COSI_NEWSIM=1 COSI_MAXATTEMPTS={args.maxAttempts} COSI_SAVE_TRAJ={trajFile} '
-        f'COSI_SAVE_SWEEP_INFO={sweepInfoFile} coalescent -R {args.recombFile} -p {paramFile} '
-        f'-v -g -r {randomSeed} --genmapRandomRegions '
-        f'--drop-singletons .25 --tped {tpedPrefix} )'
-        )
+    cosi2_argv = ['coalescent', '-R', args.recombFile, '-p', paramFile,
+                  '-v', '-g', '-r', str(randomSeed), '--genmapRandomRegions',
+                  '--drop-singletons', '.25', '--tped', tpedPrefix]
+    cosi2_env = dict(os.environ, COSI_NEWSIM='1', COSI_MAXATTEMPTS=str(args.maxAttempts),
+                     COSI_SAVE_TRAJ=trajFile, COSI_SAVE_SWEEP_INFO=sweepInfoFile)
 
     def _load_sweep_info():
-        simNum, selPop, selGen, selBegPop, selBegGen, selCoeff, selFreq = map(float, slurp_file(sweepInfoFile).strip().split())
+        with open(sweepInfoFile, 'rb') as f:
+            simNum, selPop, selGen, selBegPop, selBegGen, selCoeff, selFreq = map(float, f.read().split())
         return dict(selPop=int(selPop), selGen=selGen, selBegPop=int(selBegPop), 
                     selBegGen=selBegGen, selCoeff=selCoeff, selFreq=selFreq)
 
     replicaInfo = dict(modelId=args.modelId, blockNum=args.blockNum,
-                       replicaNum=replicaNum, succeeded=False, randomSeed=randomSeed,
-                       tpeds=emptyFile, traj=emptyFile, selPop=0, selGen=0., selBegPop=0, selBegGen=0., selCoeff=0., selFreq=0.)
+                       replicaNum=replicaNum, randomSeed=randomSeed, **_failed_replica_fields(emptyFile))
+    tarFuture = None
     try:
-        _run(cosi2_cmd)
+        _run(cosi2_argv, env=cosi2_env)
         # TODO: parse param file for list of pops, and check that we get all the files.
         tpeds_tar_gz = f"{blkStr}.tpeds.tar.gz"
-        _run(f'tar cvfz {tpeds_tar_gz} {tpedPrefix}_*.tped', timeout=args.repTimeoutSeconds)
-        replicaInfo.update(succeeded=True, tpeds=tpeds_tar_gz, traj=trajFile, **_load_sweep_info())
-    except subprocess.SubprocessError as subprocessError:
-        _log.warning(f'command "{cosi2_cmd}" failed with {subprocessError}')
+        sweepInfo = _load_sweep_info()
+
+        def _make_replica_tarball():
+            """Make the tarball; return the replica's duration including it, and the error if it failed."""
+            tarError = None
+            try:
+                _make_tarball(tpedPrefix, tpeds_tar_gz, timeout=args.repTimeoutSeconds)
+            except REPLICA_ERRORS as e:
+                tarError = e
+            return time.time()-time_beg, tarError
+
+        tarFuture = tarExecutor.submit(_make_replica_tarball)
+        replicaInfo.update(succeeded=True, tpeds=tpeds_tar_gz, traj=trajFile, **sweepInfo)
+    except REPLICA_ERRORS as replicaError:
+        _log.warning(f'replica {blkStr} (command "{" ".join(cosi2_argv)}") failed with {replicaError}')
 
     replicaInfo.update(duration=time.time()-time_beg)
 
+    return replicaInfo, tarFuture
+
+def _finish_replica(replicaInfo, tarFuture, emptyFile):
+    """Wait for the tpeds tarball of a replica returned by run_one_replica(), and return its final ReplicaInfo."""
+    if tarFuture is not None:
+        duration, tarError = tarFuture.result()
+        replicaInfo.update(duration=duration)
+        if tarError is not None:
+            _log.warning(f'making tarball {replicaInfo["tpeds"]} failed with {tarError}')
+            replicaInfo.update(_failed_replica_fields(emptyFile))
     return replicaInfo
 
 # * main
@@ -204,24 +360,57 @@ def parse_args():
     parser.add_argument('--outJson', required=True, help='write output json to this file')
     return parser.parse_args()
 
+def _write_replica_infos(fname, replicaInfos):
+    """Write the block's output json, {"replicaInfos": [...]}, to `fname`.  The outer object has a fixed
+    schema, so it is written as a literal and only the list of ReplicaInfo structs is serialized."""
+    with open(fname, 'wb') as out:
+        out.write(('{\n' + ' '*JSON_INDENT + '"replicaInfos": ').encode())
+        _dump_json(replicaInfos, out, base_indent=JSON_INDENT)
+        out.write(b'\n}\n')
+
 def constructParamFile(args):
     """Combine common and variable pars of cosi2 param file"""
 
     paramFileCombined = 'paramFileCombined.par'
-    dump_file(fname=paramFileCombined, value=slurp_file(args.paramFileCommon)+slurp_file(args.paramFile))
+    with open(paramFileCombined, 'wb') as out:
+        for paramFilePart in (args.paramFileCommon, args.paramFile):
+            with open_or_gzopen(paramFilePart, 'rb') as f:
+                # elsewhere sendfile(2) requires a socket as output; shutil uses the same check.
+                # only regular files are sent: e.g. a pipe cannot be a sendfile() input.
+                if sys.platform.startswith('linux') and not paramFilePart.endswith('.gz') \
+                   and stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+                    # copy in the kernel, without passing the data through python
+                    out.flush()
+                    while os.sendfile(out.fileno(), f.fileno(), None, 8*1024*1024):
+                        pass
+                    out.seek(0, os.SEEK_END)
+                else:
+                    shutil.copyfileobj(f, out, length=1024*1024)
     return paramFileCombined
 
+def constructEmptyFile(args):
+    """Create the empty placeholder file shared by all failed replicas of the block"""
+
+    emptyFile = f'{args.simBlockId}.empty'
+    dump_file(fname=emptyFile, value='')
+    return emptyFile
+
 def do_main():
     """Parse args and run cosi"""
 
     args = parse_args()
 
+    emptyFile = constructEmptyFile(args)
+    numWorkers = max(1, min(args.numRepsPerBlock, available_cpu_count()))
     with contextlib.ExitStack() as exit_stack:
-        executor = exit_stack.enter_context(concurrent.futures.ThreadPoolExecutor(max_workers=min(args.numRepsPerBlock,
-                                                                                                  available_cpu_count())))
-        replicaInfos = list(executor.map(functools.partial(run_one_replica, args=args, paramFile=constructParamFile(args)),
-                                         range(args.numRepsPerBlock)))
-    _write_json(args.outJson, dict(replicaInfos=replicaInfos))
+        # as many tarball workers as replica workers, so that no replica's tarball waits for another's
+        tarExecutor = exit_stack.enter_context(concurrent.futures.ThreadPoolExecutor(max_workers=numWorkers))
+        executor = exit_stack.enter_context(concurrent.futures.ThreadPoolExecutor(max_workers=numWorkers))
+        replicaResults = list(executor.map(functools.partial(run_one_replica, args=args, paramFile=constructParamFile(args),
+                                                             emptyFile=emptyFile, tarExecutor=tarExecutor),
+                                           range(args.numRepsPerBlock)))
+        replicaInfos = [_finish_replica(replicaInfo, tarFuture, emptyFile) for replicaInfo, tarFuture in replicaResults]
+    _write_replica_infos(args.outJson, replicaInfos)
     
 if __name__ == '__main__':
     logging.basicConfig(format="%(asctime)s - %(module)s:%(lineno)d:%(funcName)s - %(levelname)s - %(message)s")